@@ -0,0 +1,164 @@
+"""
+J-Quants API 共通処理
+- HTTP セッション・レート制限・認証を各スクリプトで共有
+- 営業日カレンダーは trading_days テーブルにキャッシュ
+- 日単位ジョブの並列取得
+"""
+
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+# orjson があれば使う（bytes を直接入出力）。無ければ標準 json で代用
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    json_loads = json.loads
+
+# =========================
+# 設定
+# =========================
+API_URL = "https://api.jquants.com"
+MAX_RETRY = 3           # HTTP レベルの自動リトライ回数
+REQUESTS_PER_SEC = 5    # API 呼び出しレート上限
+MAX_RATE_WAIT = 60      # レート制限ヘッダで止める最大秒数（想定外の Reset 値でも止まりっぱなしにしない）
+
+# =========================
+# 共通リクエスト
+# =========================
+# keep-alive で TCP/TLS 接続を使い回し、5xx/429 は自動リトライ
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=MAX_RETRY,
+        backoff_factor=0.75,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(["GET", "POST"])
+    )
+))
+SESSION.headers["Accept-Encoding"] = "gzip"
+
+# スレッド間で共有するレート制限（一定間隔で1リクエストずつ払い出す）
+_rate_lock = threading.Lock()
+_next_request_at = 0.0
+
+def wait_rate_limit():
+    global _next_request_at
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + 1 / REQUESTS_PER_SEC
+    if wait > 0:
+        time.sleep(wait)
+
+# 残りリクエスト数が尽きそうなら、リセット時刻まで全スレッドの払い出しを止める
+def check_rate_limit_headers(res):
+    global _next_request_at
+    remaining = res.headers.get("X-RateLimit-Remaining")
+    reset = res.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+        return
+    try:
+        remaining, reset = int(remaining), float(reset)
+    except ValueError:
+        return
+    if remaining > 1:
+        return
+
+    # Reset は UNIX 時刻（epoch 秒）か、残り秒数のどちらでも受け付ける
+    wait = reset - time.time() if reset > 1e9 else reset
+    wait = min(max(0.0, wait), MAX_RATE_WAIT)
+    print(f"[RATE] 残り {remaining} 回 (Reset={reset:g}) のため {wait:.1f} 秒停止")
+    with _rate_lock:
+        _next_request_at = max(_next_request_at, time.monotonic() + wait)
+
+def request_api(method, url, **kwargs):
+    wait_rate_limit()
+    res = SESSION.request(method, url, timeout=30, **kwargs)
+    check_rate_limit_headers(res)
+    if not res.ok:
+        raise RuntimeError(f"HTTP {res.status_code}: {res.text}")
+    return res
+
+# =========================
+# Token取得
+# =========================
+# idToken を取得し、以降のリクエストに載せる
+def authenticate(refresh_token: str):
+    res = request_api(
+        "POST",
+        f"{API_URL}/v1/token/auth_refresh",
+        params={"refreshtoken": refresh_token}
+    )
+    SESSION.headers["Authorization"] = f"Bearer {json_loads(res.content)['idToken']}"
+
+# =========================
+# 営業日取得
+# =========================
+def fetch_trading_calendar(write_conn, start: date, end: date):
+    res = request_api(
+        "GET",
+        f"{API_URL}/v1/markets/trading_calendar",
+        params={"from": start.strftime("%Y%m%d"), "to": end.strftime("%Y%m%d")}
+    )
+    rows = [
+        (d["Date"], 1 if d["HolidayDivision"] == "1" else 0)
+        for d in json_loads(res.content)["trading_calendar"]
+    ]
+    with write_conn:
+        write_conn.execute("BEGIN")
+        write_conn.executemany("INSERT OR REPLACE INTO trading_days VALUES (?, ?)", rows)
+
+# キャッシュ済み範囲（連続区間）の外側だけ API から取得し、結果は DB から返す
+def get_trading_days(read_conn, write_conn, start: date, end: date):
+    if start > end:
+        return []
+
+    lo, hi = read_conn.execute("SELECT MIN(Date), MAX(Date) FROM trading_days").fetchone()
+    if lo is None:
+        fetch_trading_calendar(write_conn, start, end)
+    else:
+        lo, hi = date.fromisoformat(lo), date.fromisoformat(hi)
+        if start < lo:
+            fetch_trading_calendar(write_conn, start, lo - timedelta(days=1))
+        if end > hi:
+            fetch_trading_calendar(write_conn, hi + timedelta(days=1), end)
+
+    rows = read_conn.execute("""
+        SELECT Date FROM trading_days
+        WHERE Date BETWEEN ? AND ? AND is_business = 1
+        ORDER BY Date
+    """, (start.isoformat(), end.isoformat())).fetchall()
+    return [date.fromisoformat(r[0]) for r in rows]
+
+# =========================
+# 並列取得
+# =========================
+# jobs の各引数タプルで fn をスレッドプール実行し、投入順に (ジョブ, Future) を返す
+# - 投入順（日付順）に書けば、途中で止まっても MAX(Date) より前に未取得日が残らない
+# - 先読みは max_workers の2倍までにして、取得済みの結果を溜め込まない
+# - 呼び出し側が途中で抜けたら、未着手のジョブはキャンセルする
+def fetch_in_order(fn, jobs, max_workers):
+    in_flight = max_workers * 2
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append((job, pool.submit(fn, *job)))
+            if len(pending) >= in_flight:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        pool.shutdown(cancel_futures=True)
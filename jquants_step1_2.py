@@ -1,23 +1,28 @@
 #!/usr/bin/env python3
 """
 J-Quants daily_quotes
-RAW(JSON gzip圧縮) + 正規化(SQLite)
+RAW(日単位JSON zlib圧縮) + 正規化(SQLite)
 営業日対応 + 失敗日リトライ管理
 """
 
 import os
-import json
-import gzip
-import sqlite3
-import requests
-from datetime import date, timedelta, datetime
+import zlib
+from datetime import date, timedelta
+
+from schema import connect, ensure_schema, batched, savepoint, bulk_insert, NORMALIZED_SCHEMA, DQ_COLS
+from jquants_api import (
+    API_URL, json_dumps, json_loads, request_api, authenticate,
+    get_trading_days, fetch_in_order,
+)
 
 # =========================
 # 設定
 # =========================
-API_URL = "https://api.jquants.com"
 DB_PATH = "jquants.db"
-MAX_RETRY = 3
+MAX_RETRY = 3           # 失敗日を再取得する回数の上限
+MAX_WORKERS = 6         # 日単位の並列取得数
+COMMIT_EVERY = 20       # 何日分ごとにコミットするか
+KEEP_RAW = True         # False なら RAW を保存せず正規化テーブルだけに書く（書き込み量・WAL が約半分）
 
 REFRESH_TOKEN = os.getenv("JQUANTS_REFRESH_TOKEN")
 if not REFRESH_TOKEN:
@@ -26,205 +31,139 @@ if not REFRESH_TOKEN:
 # =========================
 # SQLite 初期化
 # =========================
-conn = sqlite3.connect(DB_PATH)
-conn.execute("PRAGMA journal_mode=WAL;")
-conn.execute("PRAGMA auto_vacuum = FULL;")
-conn.execute("VACUUM;")
-cur = conn.cursor()
-
-# RAW（gzip圧縮JSON）
-cur.execute("""
-CREATE TABLE IF NOT EXISTS daily_quotes_raw (
-    Date TEXT,
-    Code TEXT,
-    payload BLOB,
-    PRIMARY KEY (Date, Code)
-)
-""")
-
-# 正規化テーブル
-cur.execute("""
-CREATE TABLE IF NOT EXISTS daily_quotes (
-    Date TEXT,
-    Code TEXT,
-    Open REAL,
-    High REAL,
-    Low REAL,
-    Close REAL,
-    UpperLimit TEXT,
-    LowerLimit TEXT,
-    Volume REAL,
-    TurnoverValue REAL,
-    AdjustmentFactor REAL,
-    AdjustmentOpen REAL,
-    AdjustmentHigh REAL,
-    AdjustmentLow REAL,
-    AdjustmentClose REAL,
-    AdjustmentVolume REAL,
-    MorningOpen REAL,
-    MorningHigh REAL,
-    MorningLow REAL,
-    MorningClose REAL,
-    MorningUpperLimit TEXT,
-    MorningLowerLimit TEXT,
-    MorningVolume REAL,
-    MorningTurnoverValue REAL,
-    MorningAdjustmentOpen REAL,
-    MorningAdjustmentHigh REAL,
-    MorningAdjustmentLow REAL,
-    MorningAdjustmentClose REAL,
-    MorningAdjustmentVolume REAL,
-    AfternoonOpen REAL,
-    AfternoonHigh REAL,
-    AfternoonLow REAL,
-    AfternoonClose REAL,
-    AfternoonUpperLimit TEXT,
-    AfternoonLowerLimit TEXT,
-    AfternoonVolume REAL,
-    AfternoonTurnoverValue REAL,
-    AfternoonAdjustmentOpen REAL,
-    AfternoonAdjustmentHigh REAL,
-    AfternoonAdjustmentLow REAL,
-    AfternoonAdjustmentClose REAL,
-    AfternoonAdjustmentVolume REAL,
-    PRIMARY KEY (Date, Code)
-)
-""")
-
-# 失敗日管理
-cur.execute("""
-CREATE TABLE IF NOT EXISTS failed_dates (
-    Date TEXT PRIMARY KEY,
-    last_error TEXT,
-    retry_count INTEGER DEFAULT 0
-)
-""")
+# 書き込み用と読み取り用で接続を分ける（理由は schema.connect を参照）
+write_conn = connect(DB_PATH)
+ensure_schema(write_conn, NORMALIZED_SCHEMA)
+read_conn = connect(DB_PATH, check_same_thread=False)
 
-conn.commit()
-
-# =========================
-# 共通リクエスト
-# =========================
-def request_with_error_log(method, url, **kwargs):
-    res = requests.request(method, url, **kwargs)
-    if not res.ok:
-        raise RuntimeError(f"HTTP {res.status_code}: {res.text}")
-    return res
+# INSERT 文は起動時に1度だけ組み立てる
+RAW_SQL = "INSERT OR IGNORE INTO daily_quotes_raw_daily VALUES (?, ?)"
 
 # =========================
 # Token取得
 # =========================
-def get_id_token(refresh_token: str) -> str:
-    res = request_with_error_log(
-        "POST",
-        f"{API_URL}/v1/token/auth_refresh",
-        params={"refreshtoken": refresh_token}
-    )
-    return res.json()["idToken"]
-
-headers = {
-    "Authorization": f"Bearer {get_id_token(REFRESH_TOKEN)}"
-}
+authenticate(REFRESH_TOKEN)
 print("idToken 取得成功")
 
-# =========================
-# 営業日取得
-# =========================
-def get_trading_days(start: date, end: date):
-    res = request_with_error_log(
-        "GET",
-        f"{API_URL}/v1/markets/trading_calendar",
-        headers=headers,
-        params={
-            "from": start.strftime("%Y%m%d"),
-            "to": end.strftime("%Y%m%d")
-        }
-    )
-
-    return [
-        datetime.strptime(d["Date"], "%Y-%m-%d").date()
-        for d in res.json()["trading_calendar"]
-        if d["HolidayDivision"] == "1"
-    ]
-
 # =========================
 # DB最新日
 # =========================
 def get_latest_date():
-    cur.execute("SELECT MAX(Date) FROM daily_quotes_raw")
-    row = cur.fetchone()
+    row = read_conn.execute("SELECT MAX(Date) FROM daily_quotes").fetchone()
     if row and row[0]:
-        return datetime.strptime(row[0], "%Y-%m-%d").date()
+        return date.fromisoformat(row[0])
     return None
 
 # =========================
 # 失敗日取得
 # =========================
 def get_failed_dates():
-    cur.execute("""
+    rows = read_conn.execute("""
         SELECT Date FROM failed_dates
         WHERE retry_count < ?
         ORDER BY retry_count, Date
-    """, (MAX_RETRY,))
-    return [datetime.strptime(r[0], "%Y-%m-%d").date() for r in cur.fetchall()]
+    """, (MAX_RETRY,)).fetchall()
+    return [date.fromisoformat(r[0]) for r in rows]
+
+# =========================
+# 失敗日登録
+# =========================
+# 新規は retry_count=0 で登録（読み出し不要の1文）
+# 再取得（retry=True）の失敗だけ +1 する。新規日の取得失敗で数えると、
+# ① で再取得した日を ② で再度取得して失敗したとき1回の実行で2回数えてしまう
+def record_failure(d: date, err, retry=False):
+    on_conflict = (
+        "DO UPDATE SET retry_count = retry_count + 1, last_error = excluded.last_error"
+        if retry else "DO NOTHING"
+    )
+    write_conn.execute(f"""
+        INSERT INTO failed_dates(Date, last_error, retry_count)
+        VALUES (?, ?, 0)
+        ON CONFLICT(Date) {on_conflict}
+    """, (d.isoformat(), str(err)))
+
+# =========================
+# RAW 保存済み日
+# =========================
+def get_raw_dates(days):
+    if not days:
+        return set()
+    rows = read_conn.execute(
+        "SELECT Date FROM daily_quotes_raw_daily WHERE Date BETWEEN ? AND ?",
+        (min(days).isoformat(), max(days).isoformat())
+    ).fetchall()
+    stored = {r[0] for r in rows}
+    return {d for d in days if d.isoformat() in stored}
+
+# =========================
+# RAW 圧縮
+# =========================
+# 先頭1バイトに形式バージョンを付け、読み出し側でコーデックを選べるようにする
+RAW_FORMAT_ZLIB = b"\x01"
+
+def pack_raw(payload: bytes) -> bytes:
+    return RAW_FORMAT_ZLIB + zlib.compress(payload, 6)
 
 # =========================
 # 日次株価取得（1日）
 # =========================
-def fetch_one_day(headers, target_date: date):
-    date_str = target_date.strftime("%Y%m%d")
-    pagination_key = None
-    saved = 0
+# API から取得して (RAW行, 正規化行) を返すだけで DB には書き込まない
+# RAW が保存済みの日は need_raw=False で再シリアライズ・圧縮を省く
+def fetch_one_day(target_date: date, need_raw=True):
+    params = {"date": target_date.strftime("%Y%m%d")}
+    quotes_all = []
+    norm_rows = []
 
     while True:
-        params = {"date": date_str}
-        if pagination_key:
-            params["pagination_key"] = pagination_key
-
-        res = request_with_error_log(
+        res = request_api(
             "GET",
             f"{API_URL}/v1/prices/daily_quotes",
-            headers=headers,
             params=params
         )
 
-        data = res.json()
+        data = json_loads(res.content)
         quotes = data.get("daily_quotes", [])
         pagination_key = data.get("pagination_key")
 
         if not quotes:
             break
 
-        for q in quotes:
-            d = q["Date"]
-            c = q["Code"]
+        if need_raw:
+            quotes_all.extend(quotes)
 
-            # --- RAW gzip圧縮 ---
-            compressed = gzip.compress(
-                json.dumps(q, ensure_ascii=False).encode("utf-8")
-            )
+        # --- 正規化（欠損キーは None） ---
+        norm_rows.extend(tuple(q.get(col) for col in DQ_COLS) for q in quotes)
 
-            cur.execute("""
-            INSERT OR IGNORE INTO daily_quotes_raw
-            VALUES (?, ?, ?)
-            """, (d, c, compressed))
-
-            # --- 正規化 ---
-            cols = ",".join(q.keys())
-            ph = ",".join(["?"] * len(q))
-            cur.execute(
-                f"INSERT OR IGNORE INTO daily_quotes ({cols}) VALUES ({ph})",
-                list(q.values())
-            )
+        if not pagination_key:
+            break
+        params["pagination_key"] = pagination_key
 
-            saved += 1
+    if not quotes_all:
+        return None, norm_rows
 
-        conn.commit()
+    # --- RAW zlib圧縮（1日1回） ---
+    raw_row = (target_date.isoformat(), pack_raw(json_dumps(quotes_all)))
+    return raw_row, norm_rows
 
-        if not pagination_key:
-            break
+# =========================
+# 日次株価保存（1日）
+# =========================
+# コミットは呼び出し側（batched）に任せる
+def save_one_day(raw_row, norm_rows):
+    if raw_row:
+        write_conn.execute(RAW_SQL, raw_row)
+    return bulk_insert(write_conn, "daily_quotes", DQ_COLS, norm_rows, verb="INSERT OR IGNORE")
 
-    return saved
+# =========================
+# 並列取得
+# =========================
+# 複数日をスレッドプールで並列取得し、投入順（日付順）に (日付, Future) を返す
+def fetch_days(days):
+    # RAW を残さない設定なら全日 need_raw=False（圧縮も INSERT もしない）
+    raw_dates = get_raw_dates(days) if KEEP_RAW else set(days)
+    jobs = [(d, d not in raw_dates) for d in days]
+    for (d, _), fut in fetch_in_order(fetch_one_day, jobs, MAX_WORKERS):
+        yield d, fut
 
 # =========================
 # メイン処理
@@ -232,47 +171,42 @@ def fetch_one_day(headers, target_date: date):
 def run_update(initial_days=180):
     today = date.today()
 
-    # ① 失敗日の再取得
-    for d in get_failed_dates():
+    # ① 失敗日の再取得（DB 書き込みはメインスレッドのみ）
+    for d, fut in batched(write_conn, fetch_days(get_failed_dates()), COMMIT_EVERY):
         print(f"[RETRY] {d}")
         try:
-            cnt = fetch_one_day(headers, d)
-            cur.execute("DELETE FROM failed_dates WHERE Date=?", (d.strftime("%Y-%m-%d"),))
-            conn.commit()
+            rows = fut.result()
+            # 1日分の保存と失敗日の削除は同じ SAVEPOINT に入れる
+            with savepoint(write_conn):
+                cnt = save_one_day(*rows)
+                write_conn.execute("DELETE FROM failed_dates WHERE Date=?", (d.isoformat(),))
             print(f"[OK] {d}: {cnt} 件")
         except Exception as e:
-            cur.execute("""
-                UPDATE failed_dates
-                SET retry_count = retry_count + 1,
-                    last_error = ?
-                WHERE Date=?
-            """, (str(e), d.strftime("%Y-%m-%d")))
-            conn.commit()
+            record_failure(d, e, retry=True)
             print(f"[FAIL] {d}: {e}")
 
     # ② 新規日取得
     latest = get_latest_date()
     start = latest + timedelta(days=1) if latest else today - timedelta(days=initial_days)
 
-    trading_days = get_trading_days(start, today)
+    trading_days = get_trading_days(read_conn, write_conn, start, today)
 
-    for d in trading_days:
+    for d, fut in batched(write_conn, fetch_days(trading_days), COMMIT_EVERY):
         print(f"[FETCH] {d}")
         try:
-            cnt = fetch_one_day(headers, d)
+            rows = fut.result()
+            with savepoint(write_conn):
+                cnt = save_one_day(*rows)
             print(f"[SAVE] {d}: {cnt} 件")
         except Exception as e:
-            cur.execute("""
-                INSERT OR IGNORE INTO failed_dates(Date, last_error, retry_count)
-                VALUES (?, ?, 0)
-            """, (d.strftime("%Y-%m-%d"), str(e)))
-            conn.commit()
+            record_failure(d, e)
             print(f"[ERROR] {d}: failed 登録")
 
 # =========================
 # 実行
 # =========================
 run_update()
-conn.close()
+write_conn.close()
+read_conn.close()
 print("DBクローズ完了")
 
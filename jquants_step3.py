@@ -6,17 +6,24 @@ J-Quants JSON-Based Pipeline (Schema-less)
 """
 
 import os
-import json
-import sqlite3
-import requests
-from datetime import date, timedelta, datetime
+from datetime import date, timedelta
+
+from schema import (
+    connect, ensure_schema, ensure_fin_num_cols, ensure_dq_gen_cols,
+    batched, savepoint, bulk_insert, to_real,
+    JSON_SCHEMA, FIN_NUM_COLS,
+)
+from jquants_api import (
+    API_URL, json_dumps, json_loads, request_api, authenticate,
+    get_trading_days, fetch_in_order,
+)
 
 # =========================
 # 設定
 # =========================
-API_URL = "https://api.jquants.com"
 DB_PATH = "jquants.db"
-MAX_RETRY = 3
+MAX_WORKERS = 6         # 日単位の並列取得数
+COMMIT_EVERY = 20       # 何日分ごとにコミットするか
 
 REFRESH_TOKEN = os.getenv("JQUANTS_REFRESH_TOKEN")
 if not REFRESH_TOKEN:
@@ -25,146 +32,99 @@ if not REFRESH_TOKEN:
 # =========================
 # SQLite 初期化 (超シンプル化)
 # =========================
-conn = sqlite3.connect(DB_PATH)
-conn.execute("PRAGMA journal_mode=WAL;")
-cur = conn.cursor()
-
-# 株価テーブル: 日付とコード以外は全て "data" に入れる
-cur.execute("""
-CREATE TABLE IF NOT EXISTS daily_quotes (
-    Date TEXT,
-    Code TEXT,
-    data JSON,
-    PRIMARY KEY (Date, Code)
-)
-""")
-
-# 財務テーブル: 日付とコード以外は全て "data" に入れる
-cur.execute("""
-CREATE TABLE IF NOT EXISTS financials (
-    Date TEXT,
-    Code TEXT,
-    data JSON,
-    PRIMARY KEY (Date, Code)
-)
-""")
-
-# エラー管理用
-cur.execute("""
-CREATE TABLE IF NOT EXISTS failed_log (
-    Date TEXT,
-    Type TEXT,
-    Msg TEXT,
-    Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-)
-""")
-conn.commit()
+# 書き込み用と読み取り用で接続を分ける（理由は schema.connect を参照）
+write_conn = connect(DB_PATH)
+ensure_schema(write_conn, JSON_SCHEMA)
+ensure_fin_num_cols(write_conn)
+ensure_dq_gen_cols(write_conn)
+read_conn = connect(DB_PATH, check_same_thread=False)
+
+# INSERT 先のカラム（取得関数が返す行のタプル順と一致させる）
+DQ_INS_COLS = ("Date", "Code", "data")
+FIN_INS_COLS = ("Date", "Code", "data", *FIN_NUM_COLS)
 
 # =========================
 # 共通処理
 # =========================
-def request_api(method, url, **kwargs):
-    res = requests.request(method, url, **kwargs)
-    if not res.ok:
-        raise RuntimeError(f"HTTP {res.status_code}: {res.text}")
-    return res
-
-def get_id_token():
-    res = request_api(
-        "POST",
-        f"{API_URL}/v1/token/auth_refresh",
-        params={"refreshtoken": REFRESH_TOKEN}
-    )
-    return res.json()["idToken"]
-
-headers = {"Authorization": f"Bearer {get_id_token()}"}
+authenticate(REFRESH_TOKEN)
 print("idToken 取得成功")
 
 def log_error(date_str, type_str, msg):
     try:
-        cur.execute("INSERT INTO failed_log (Date, Type, Msg) VALUES (?, ?, ?)", (date_str, type_str, str(msg)))
-        conn.commit()
+        # コミットは呼び出し側（batched）に任せる
+        write_conn.execute("INSERT INTO failed_log (Date, Type, Msg) VALUES (?, ?, ?)", (date_str, type_str, str(msg)))
     except:
         pass
 
 # =========================
 # 株価ロジック
 # =========================
-def get_trading_days(start: date, end: date):
-    res = request_api(
-        "GET",
-        f"{API_URL}/v1/markets/trading_calendar",
-        headers=headers,
-        params={"from": start.strftime("%Y%m%d"), "to": end.strftime("%Y%m%d")}
-    )
-    return [
-        datetime.strptime(d["Date"], "%Y-%m-%d").date()
-        for d in res.json()["trading_calendar"]
-        if d["HolidayDivision"] == "1"
-    ]
-
+# API から取得して行を返すだけで DB には書き込まない
 def fetch_daily_quotes(d: date):
-    pagination_key = None
+    params = {"date": d.strftime("%Y%m%d")}
+    rows = []
     while True:
-        params = {"date": d.strftime("%Y%m%d")}
-        if pagination_key:
-            params["pagination_key"] = pagination_key
-
-        res = request_api("GET", f"{API_URL}/v1/prices/daily_quotes", headers=headers, params=params)
-        data = res.json()
+        res = request_api("GET", f"{API_URL}/v1/prices/daily_quotes", params=params)
+        data = json_loads(res.content)
         pagination_key = data.get("pagination_key")
 
-        # バッチインサート用リスト
-        rows = []
-        for q in data.get("daily_quotes", []):
-            # JSONとしてそのまま保存
-            rows.append((
-                q["Date"],
-                q["Code"],
-                json.dumps(q, ensure_ascii=False)
-            ))
-        
-        if rows:
-            cur.executemany(
-                "INSERT OR REPLACE INTO daily_quotes (Date, Code, data) VALUES (?, ?, ?)",
-                rows
-            )
-            conn.commit()
+        # JSONとしてそのまま保存
+        rows.extend(
+            (q["Date"], q["Code"], json_dumps(q).decode("utf-8"))
+            for q in data.get("daily_quotes", [])
+        )
 
         if not pagination_key:
             break
+        params["pagination_key"] = pagination_key
+
+    return rows
 
 # =========================
 # 財務ロジック
 # =========================
 def fetch_financials(d: date):
-    pagination_key = None
+    params = {"date": d.strftime("%Y%m%d")}
+    rows = []
     while True:
-        params = {"date": d.strftime("%Y%m%d")}
-        if pagination_key:
-            params["pagination_key"] = pagination_key
-
-        res = request_api("GET", f"{API_URL}/v1/fins/statements", headers=headers, params=params)
-        data = res.json()
+        res = request_api("GET", f"{API_URL}/v1/fins/statements", params=params)
+        data = json_loads(res.content)
         pagination_key = data.get("pagination_key")
 
-        rows = []
-        for s in data.get("statements", []):
-            rows.append((
+        # 1行 = (開示日, コード, JSON, 数値カラム...) のタプル内包表記のみ
+        rows.extend(
+            (
                 s["DisclosedDate"],
                 s["LocalCode"],
-                json.dumps(s, ensure_ascii=False)
-            ))
-
-        if rows:
-            cur.executemany(
-                "INSERT OR REPLACE INTO financials (Date, Code, data) VALUES (?, ?, ?)",
-                rows
+                json_dumps(s).decode("utf-8"),
+                *(to_real(s.get(k)) for k in FIN_NUM_COLS),
             )
-            conn.commit()
+            for s in data.get("statements", [])
+        )
 
         if not pagination_key:
             break
+        params["pagination_key"] = pagination_key
+
+    return rows
+
+# =========================
+# 並列取得
+# =========================
+# 種別ごとの (取得関数, INSERT 先テーブル, カラム)
+FETCHERS = {
+    "PRICE": (fetch_daily_quotes, "daily_quotes", DQ_INS_COLS),
+    "FIN": (fetch_financials, "financials", FIN_INS_COLS),
+}
+
+def fetch_job(kind, d):
+    return FETCHERS[kind][0](d)
+
+# 株価・財務の全ジョブを1つのスレッドプールで並列取得し、
+# 投入順（種別ごとに日付順）に (種別, 日付, Future) を返す
+def fetch_days(jobs):
+    for (kind, d), fut in fetch_in_order(fetch_job, jobs, MAX_WORKERS):
+        yield kind, d, fut
 
 # =========================
 # メイン実行
@@ -173,41 +133,37 @@ def main():
     today = date.today()
 
     # --- Daily Quotes ---
-    print("=== DAILY QUOTES ===")
-    cur.execute("SELECT MAX(Date) FROM daily_quotes")
-    latest_price = cur.fetchone()[0]
+    latest_price = read_conn.execute("SELECT MAX(Date) FROM daily_quotes").fetchone()[0]
     
-    start_price = datetime.strptime(latest_price, "%Y-%m-%d").date() + timedelta(days=1) if latest_price else today - timedelta(days=365)
+    start_price = date.fromisoformat(latest_price) + timedelta(days=1) if latest_price else today - timedelta(days=365)
     
-    target_days = get_trading_days(start_price, today)
+    target_days = get_trading_days(read_conn, write_conn, start_price, today)
     print(f"Fetching {len(target_days)} days for Prices...")
-    
-    for d in target_days:
-        try:
-            fetch_daily_quotes(d)
-            print(f"[PRICE] {d} - OK")
-        except Exception as e:
-            print(f"[PRICE] {d} - FAIL: {e}")
-            log_error(str(d), "PRICE", e)
 
     # --- Financials ---
-    print("\n=== FINANCIALS ===")
-    cur.execute("SELECT MAX(Date) FROM financials")
-    latest_fin = cur.fetchone()[0]
-    
-    start_fin = datetime.strptime(latest_fin, "%Y-%m-%d").date() + timedelta(days=1) if latest_fin else today - timedelta(days=365*2)
-    d = start_fin
+    latest_fin = read_conn.execute("SELECT MAX(Date) FROM financials").fetchone()[0]
     
-    while d <= today:
+    start_fin = date.fromisoformat(latest_fin) + timedelta(days=1) if latest_fin else today - timedelta(days=365*2)
+    # 開示は営業日のみなので、休日は API を呼ばない
+    fin_days = get_trading_days(read_conn, write_conn, start_fin, today)
+    print(f"Fetching {len(fin_days)} days for Financials...")
+
+    # 株価と財務の取得を重ねて並列実行、DB 書き込みはメインスレッドのみ
+    print("\n=== DAILY QUOTES / FINANCIALS ===")
+    jobs = [("PRICE", d) for d in target_days] + [("FIN", d) for d in fin_days]
+    for kind, d, fut in batched(write_conn, fetch_days(jobs), COMMIT_EVERY):
+        label = f"[{kind}]".ljust(7)
         try:
-            fetch_financials(d)
-            print(f"[FIN]   {d} - OK")
+            rows = fut.result()
+            with savepoint(write_conn):
+                bulk_insert(write_conn, *FETCHERS[kind][1:], rows)
+            print(f"{label} {d} - OK")
         except Exception as e:
-            # 財務は休日でもAPIレスポンスがある場合がある（空など）のでエラーログだけ残して進む
-            print(f"[FIN]   {d} - FAIL: {e}")
-            log_error(str(d), "FIN", e)
-        d += timedelta(days=1)
+            # 失敗してもエラーログだけ残して次の日へ進む
+            print(f"{label} {d} - FAIL: {e}")
+            log_error(str(d), kind, e)
 
 if __name__ == "__main__":
     main()
-    conn.close()
+    write_conn.close()
+    read_conn.close()
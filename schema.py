@@ -0,0 +1,284 @@
+"""
+J-Quants SQLite スキーマ
+- 接続時 PRAGMA と CREATE TABLE を各スクリプトで共有
+- 正規化版(step1_2) と JSON版(step3) は同名テーブルの定義が異なるため別スキーマ
+"""
+
+import sqlite3
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+
+# =========================
+# 接続設定
+# =========================
+PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-262144",       # 256MB
+    "mmap_size=30000000000",    # 実際の上限は SQLite 側のコンパイル時設定で丸められる
+    "wal_autocheckpoint=10000",
+)
+
+# isolation_level=None: 暗黙の BEGIN を使わず、書き込み側で BEGIN/COMMIT を明示する
+# 各スクリプトは書き込み用と読み取り用の2接続を開く。WAL なので読み取りは
+# 書き込み側の長いトランザクション（batched）を待たず、コミット済みの内容を見る。
+# 書き込みはメインスレッドのみで行うため、書き込み用接続にロックは付けない
+def connect(db_path, **kwargs):
+    conn = sqlite3.connect(db_path, isolation_level=None, **kwargs)
+    for p in PRAGMAS:
+        conn.execute(f"PRAGMA {p};")
+    return conn
+
+# =========================
+# トランザクション
+# =========================
+# items を回しながら every 件ごとに1トランザクションでコミットする
+# （途中で落ちたら未コミット分だけ失う）。各 item の書き込みは savepoint で囲む
+def batched(conn, items, every):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for i, item in enumerate(items, 1):
+            yield item
+            if i % every == 0:
+                conn.commit()
+                conn.execute("BEGIN IMMEDIATE")
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+# batched のトランザクション内で1件分を SAVEPOINT で囲み、例外時はその1件だけ巻き戻す
+# （バッチ内の他の件は残り、まとめてコミットされる）
+@contextmanager
+def savepoint(conn, name="day"):
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        yield
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        raise
+    conn.execute(f"RELEASE {name}")
+
+# =========================
+# 複数行 INSERT
+# =========================
+# SQLite のホスト変数上限（旧既定値 999）に収まるよう1文あたりの行数を抑える
+MAX_VARS = 999
+
+@lru_cache(maxsize=None)
+def _values_sql(verb, table, cols, n):
+    row = "(" + ",".join("?" * len(cols)) + ")"
+    return f"{verb} INTO {table} ({','.join(cols)}) VALUES " + ",".join([row] * n)
+
+# chunk 行ずつ VALUES (...),(...) の1文で流し、端数は executemany で入れる
+def bulk_insert(conn, table, cols, rows, chunk=50, verb="INSERT OR REPLACE"):
+    cols = tuple(cols)
+    chunk = max(1, min(chunk, MAX_VARS // len(cols)))
+    full = len(rows) - len(rows) % chunk
+    if full:
+        sql = _values_sql(verb, table, cols, chunk)
+        for i in range(0, full, chunk):
+            conn.execute(sql, list(chain.from_iterable(rows[i:i + chunk])))
+    if full < len(rows):
+        conn.executemany(_values_sql(verb, table, cols, 1), rows[full:])
+    return len(rows)
+
+# =========================
+# 正規化スキーマ (step1_2)
+# =========================
+NORMALIZED_SCHEMA = """
+-- RAW（1日分の JSON 配列を zlib 圧縮して1行に格納）
+CREATE TABLE IF NOT EXISTS daily_quotes_raw_daily (
+    Date TEXT PRIMARY KEY,
+    payload BLOB
+);
+
+-- 正規化テーブル
+CREATE TABLE IF NOT EXISTS daily_quotes (
+    Date TEXT,
+    Code TEXT,
+    Open REAL,
+    High REAL,
+    Low REAL,
+    Close REAL,
+    UpperLimit TEXT,
+    LowerLimit TEXT,
+    Volume REAL,
+    TurnoverValue REAL,
+    AdjustmentFactor REAL,
+    AdjustmentOpen REAL,
+    AdjustmentHigh REAL,
+    AdjustmentLow REAL,
+    AdjustmentClose REAL,
+    AdjustmentVolume REAL,
+    MorningOpen REAL,
+    MorningHigh REAL,
+    MorningLow REAL,
+    MorningClose REAL,
+    MorningUpperLimit TEXT,
+    MorningLowerLimit TEXT,
+    MorningVolume REAL,
+    MorningTurnoverValue REAL,
+    MorningAdjustmentOpen REAL,
+    MorningAdjustmentHigh REAL,
+    MorningAdjustmentLow REAL,
+    MorningAdjustmentClose REAL,
+    MorningAdjustmentVolume REAL,
+    AfternoonOpen REAL,
+    AfternoonHigh REAL,
+    AfternoonLow REAL,
+    AfternoonClose REAL,
+    AfternoonUpperLimit TEXT,
+    AfternoonLowerLimit TEXT,
+    AfternoonVolume REAL,
+    AfternoonTurnoverValue REAL,
+    AfternoonAdjustmentOpen REAL,
+    AfternoonAdjustmentHigh REAL,
+    AfternoonAdjustmentLow REAL,
+    AfternoonAdjustmentClose REAL,
+    AfternoonAdjustmentVolume REAL,
+    PRIMARY KEY (Date, Code)
+);
+
+-- 失敗日管理
+CREATE TABLE IF NOT EXISTS failed_dates (
+    Date TEXT PRIMARY KEY,
+    last_error TEXT,
+    retry_count INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_failed_retry ON failed_dates(retry_count, Date);
+
+-- 営業日カレンダーのキャッシュ（過去分は再取得しない）
+CREATE TABLE IF NOT EXISTS trading_days (
+    Date TEXT PRIMARY KEY,
+    is_business INTEGER
+);
+"""
+
+# daily_quotes のカラム順（CREATE TABLE と一致させる）
+DQ_COLS = (
+    "Date", "Code", "Open", "High", "Low", "Close", "UpperLimit", "LowerLimit",
+    "Volume", "TurnoverValue", "AdjustmentFactor", "AdjustmentOpen",
+    "AdjustmentHigh", "AdjustmentLow", "AdjustmentClose", "AdjustmentVolume",
+    "MorningOpen", "MorningHigh", "MorningLow", "MorningClose",
+    "MorningUpperLimit", "MorningLowerLimit", "MorningVolume",
+    "MorningTurnoverValue", "MorningAdjustmentOpen", "MorningAdjustmentHigh",
+    "MorningAdjustmentLow", "MorningAdjustmentClose",
+    "MorningAdjustmentVolume", "AfternoonOpen", "AfternoonHigh",
+    "AfternoonLow", "AfternoonClose", "AfternoonUpperLimit",
+    "AfternoonLowerLimit", "AfternoonVolume", "AfternoonTurnoverValue",
+    "AfternoonAdjustmentOpen", "AfternoonAdjustmentHigh",
+    "AfternoonAdjustmentLow", "AfternoonAdjustmentClose",
+    "AfternoonAdjustmentVolume",
+)
+
+# =========================
+# JSON スキーマ (step3)
+# =========================
+JSON_SCHEMA = """
+-- 株価テーブル: 日付とコード以外は全て "data" に入れる
+-- 選定クエリで使う数値は data から導出する生成カラム (DQ_GEN_COLS)
+CREATE TABLE IF NOT EXISTS daily_quotes (
+    Date TEXT,
+    Code TEXT,
+    data JSON,
+    Close REAL AS (CAST(json_extract(data, '$.Close') AS REAL)) VIRTUAL,
+    Volume REAL AS (CAST(json_extract(data, '$.Volume') AS REAL)) VIRTUAL,
+    PRIMARY KEY (Date, Code)
+);
+
+-- 財務テーブル: 日付とコード以外は全て "data" に入れる
+-- 選定クエリで使う数値だけは REAL カラムにも持つ (FIN_NUM_COLS)
+CREATE TABLE IF NOT EXISTS financials (
+    Date TEXT,
+    Code TEXT,
+    data JSON,
+    NetSales REAL,
+    ForecastNetSales REAL,
+    Profit REAL,
+    Equity REAL,
+    EarningsPerShare REAL,
+    ForecastEarningsPerShare REAL,
+    PRIMARY KEY (Date, Code)
+);
+-- 銘柄ごとの最新決算を索引だけで引けるようにする
+CREATE INDEX IF NOT EXISTS idx_fin_code_date ON financials(Code, Date DESC);
+
+-- エラー管理用
+CREATE TABLE IF NOT EXISTS failed_log (
+    Date TEXT,
+    Type TEXT,
+    Msg TEXT,
+    Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 営業日カレンダーのキャッシュ（過去分は再取得しない）
+CREATE TABLE IF NOT EXISTS trading_days (
+    Date TEXT PRIMARY KEY,
+    is_business INTEGER
+);
+"""
+
+# financials の数値カラム（API のキー名のまま。CREATE TABLE と一致させる）
+FIN_NUM_COLS = (
+    "NetSales", "ForecastNetSales", "Profit", "Equity",
+    "EarningsPerShare", "ForecastEarningsPerShare",
+)
+
+# daily_quotes の生成カラム（API のキー名のまま。CREATE TABLE と一致させる）
+DQ_GEN_COLS = ("Close", "Volume")
+
+# =========================
+# 初期化
+# =========================
+# CREATE TABLE IF NOT EXISTS をまとめて1回の executescript で流す
+def ensure_schema(conn, schema):
+    conn.executescript(schema)
+
+# API の数値は文字列（欠損は空文字）なので REAL 用に変換する
+# 取り込み時も既存 DB の埋め直しも同じ規則: 数値として読めない値（空文字・'-' 等）は NULL
+def to_real(v):
+    if v in ("", None):
+        return None
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+# 数値カラム追加前の既存 DB は ALTER TABLE で列を足し、data から埋め直す
+def ensure_fin_num_cols(conn):
+    have = {r[1] for r in conn.execute("PRAGMA table_info(financials)")}
+    missing = [c for c in FIN_NUM_COLS if c not in have]
+    if not missing:
+        return
+
+    # CAST だと 'abc' や '-' が 0 になるので、取り込み時と同じ to_real で変換する
+    conn.create_function("to_real", 1, to_real, deterministic=True)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for c in missing:
+            conn.execute(f"ALTER TABLE financials ADD COLUMN {c} REAL")
+        conn.execute("UPDATE financials SET " + ", ".join(
+            f"{c} = to_real(json_extract(data, '$.{c}'))"
+            for c in missing
+        ))
+
+# 生成カラム追加前の既存 DB は ALTER TABLE で足す（ALTER で足せるのは VIRTUAL のみ）
+# 索引には計算済みの値が入るので、選定クエリは data を読まずに索引だけで済む
+def ensure_dq_gen_cols(conn):
+    have = {r[1] for r in conn.execute("PRAGMA table_xinfo(daily_quotes)")}
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for c in DQ_GEN_COLS:
+            if c not in have:
+                conn.execute(
+                    f"ALTER TABLE daily_quotes ADD COLUMN {c} REAL "
+                    f"AS (CAST(json_extract(data, '$.{c}') AS REAL)) VIRTUAL"
+                )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_dq_date_close "
+            f"ON daily_quotes(Date, Code, {', '.join(DQ_GEN_COLS)})"
+        )
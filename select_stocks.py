@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 """
-Buy Candidates (Schema-less JSON Version)
-- SQLiteのJSON関数を使ってクエリ実行
+Buy Candidates (JSON Version DB)
+- jquants_step3.py が作る DB の数値カラム（財務の REAL カラム・株価の生成カラム）でクエリ実行
+- 事前に jquants_step3.py を実行し、カラム追加のマイグレーションを済ませておくこと
 """
 
 import sqlite3
@@ -11,130 +12,127 @@ DB_PATH = "jquants.db"
 
 conn = sqlite3.connect(DB_PATH)
 conn.row_factory = sqlite3.Row
-cur = conn.cursor()
+
+# log10 は SQLite の数学関数（ビルド時オプション）。無い環境では Python 側で登録
+try:
+    conn.execute("SELECT log10(10)")
+except sqlite3.OperationalError:
+    conn.create_function("log10", 1, math.log10, deterministic=True)
 
 # 最新日付の取得
-cur.execute("SELECT MAX(Date) FROM daily_quotes")
-latest_price_date = cur.fetchone()[0]
+latest_price_date = conn.execute("SELECT MAX(Date) FROM daily_quotes").fetchone()[0]
 print(f"Target Price Date: {latest_price_date}")
 
 # =========================
-# JSON抽出用SQL
+# 選定SQL
 # =========================
 # ポイント:
-# 1. json_extract(data, '$.KeyName') で値を取り出す
-# 2. 取り出した値は文字列扱いなので、CAST(... AS REAL) で数値化する
+# 1. 株価の Close / Volume は data から導出した生成カラム（idx_dq_date_close に格納済み）
+# 2. 財務の数値は REAL カラムをそのまま使う（CAST 不要）
+# 3. どちらも JSON を行ごとに解析し直さない
 # =========================
 
 sql = """
-WITH latest_fin AS (
-    SELECT 
+WITH target_price AS (
+    SELECT
         Code,
-        data,
-        ROW_NUMBER() OVER (PARTITION BY Code ORDER BY Date DESC) as rn
-    FROM financials
-),
-target_price AS (
-    SELECT 
-        Code, 
-        data 
+        Close,
+        Volume
     FROM daily_quotes
     WHERE Date = ?
-)
-SELECT
-    f.Code,
+),
+candidates AS (
+    SELECT
+        f.Code,
     
-    -- 株価データ (JSONから抽出)
-    CAST(json_extract(p.data, '$.Close') AS REAL) AS close_price,
-    CAST(json_extract(p.data, '$.Volume') AS REAL) AS volume,
+        -- 株価データ (生成カラム)
+        p.Close AS close_price,
+        p.Volume AS volume,
 
-    -- 財務データ (JSONから抽出)
-    CAST(json_extract(f.data, '$.NetSales') AS REAL) AS net_sales,
-    CAST(json_extract(f.data, '$.ForecastNetSales') AS REAL) AS forecast_net_sales,
+        -- 財務データ (取り込み時に REAL カラム化済み)
+        f.NetSales AS net_sales,
+        f.ForecastNetSales AS forecast_net_sales,
     
-    CAST(json_extract(f.data, '$.Profit') AS REAL) AS profit,
-    CAST(json_extract(f.data, '$.Equity') AS REAL) AS equity,
+        f.Profit AS profit,
+        f.Equity AS equity,
     
-    CAST(json_extract(f.data, '$.EarningsPerShare') AS REAL) AS eps,
-    CAST(json_extract(f.data, '$.ForecastEarningsPerShare') AS REAL) AS forecast_eps
-
-FROM latest_fin f
-JOIN target_price p
-  ON f.Code = p.Code
-WHERE
-    f.rn = 1 -- 最新決算のみ
+        f.EarningsPerShare AS eps,
+        f.ForecastEarningsPerShare AS forecast_eps
+
+    FROM target_price p
+    JOIN financials f
+      ON f.Code = p.Code
+     -- 最新決算のみ (idx_fin_code_date で銘柄ごとに1回の索引参照)
+     AND f.Date = (SELECT MAX(f2.Date) FROM financials f2 WHERE f2.Code = p.Code)
+    WHERE
+        -- フィルタリング条件は数値カラムに対して行う
+        profit > 0
+        AND equity > 0
+        AND forecast_eps > 0
+        AND volume > 10000
     
-    -- フィルタリング条件もJSON抽出値に対して行う
-    AND profit > 0
-    AND equity > 0
-    AND forecast_eps > 0
-    AND volume > 10000
+        -- 売上維持率 > 95%
+        AND forecast_net_sales > net_sales * 0.95
     
-    -- 売上維持率 > 95%
-    AND forecast_net_sales > net_sales * 0.95
+        -- ROE >= 8% (計算式)
+        AND (profit / equity) >= 0.08
     
-    -- ROE >= 8% (計算式)
-    AND (profit / equity) >= 0.08
-    
-    -- PER 5~40倍
-    AND (close_price / forecast_eps) BETWEEN 5 AND 40
+        -- PER 5~40倍
+        AND (close_price / forecast_eps) BETWEEN 5 AND 40
+
+        -- ゼロ除算でスコアを計算できない銘柄は除外
+        AND net_sales <> 0
+
+        -- EPS が空文字なら成長率 0 扱い（従来どおり）
+        -- null / キー無し / 数値として読めない値（'-' 等）は除外
+        -- REAL カラムではいずれも NULL (to_real) なので、NULL の行だけ data を見て空文字を区別する
+        AND (eps IS NOT NULL OR json_extract(f.data, '$.EarningsPerShare') = '')
+)
+SELECT
+    Code,
+    close_price,
+    (profit / equity) * 100 AS roe,
+    close_price / forecast_eps AS per,
+    forecast_eps,
+    (forecast_net_sales / net_sales - 1) * 100 AS sales_growth,
+
+    -- スコア = ROE*50 + EPS成長率*30 + log10(出来高)*2
+    (profit / equity) * 100 * 0.5
+    + CASE WHEN eps > 0 THEN (forecast_eps - eps) / abs(eps) ELSE 0 END * 100 * 0.3
+    + CASE WHEN volume > 0 THEN log10(volume) ELSE 0 END * 10 * 0.2 AS score,
+
+    COUNT(*) OVER () AS total
+FROM candidates
+ORDER BY score DESC, Code
+LIMIT 50
 """
 
 try:
-    rows = cur.execute(sql, (latest_price_date,)).fetchall()
+    rows = conn.execute(sql, (latest_price_date,)).fetchall()
 except sqlite3.OperationalError as e:
     print(f"SQL Error: {e}")
-    print("※ SQLiteのバージョンが古い可能性があります。Python 3.9以上推奨。")
+    if "no such column" in str(e):
+        # 数値カラムは jquants_step3.py 起動時のマイグレーションで追加される
+        print("※ DB が未マイグレーションです。先に jquants_step3.py を実行してください。")
+    else:
+        # 生成カラムは SQLite 3.31 以上、ウィンドウ関数は 3.25 以上が必要
+        print("※ SQLiteのバージョンが古い可能性があります（3.31 以上が必要）。")
     exit()
 
 # =========================
-# スコアリング (ロジックは同じ)
+# 出力 (スコア計算・並べ替え・上位50件の抽出は SQL 側で完了)
 # =========================
-candidates = []
+total = rows[0]["total"] if rows else 0
+print(f"\n=== BUY CANDIDATES ({total} records) ===")
 for r in rows:
-    try:
-        # 既にSQLでCASTしているので、ここでは数値として扱える
-        close_price = r["close_price"]
-        roe = r["profit"] / r["equity"]
-        eps = r["eps"]
-        f_eps = r["forecast_eps"]
-        volume = r["volume"]
-        
-        # EPS成長率
-        eps_growth = ((f_eps - eps) / abs(eps)) if eps > 0 else 0
-        
-        # PER
-        per = close_price / f_eps if f_eps > 0 else 0
-
-        # 流動性スコア
-        liquidity_score = math.log10(volume) if volume > 0 else 0
-
-        score = (roe * 100 * 0.5) + (eps_growth * 100 * 0.3) + (liquidity_score * 10 * 0.2)
-
-        candidates.append({
-            "code": r["Code"],
-            "price": int(close_price),
-            "roe": roe * 100,
-            "per": per,
-            "eps": f_eps,
-            "sales_growth": (r["forecast_net_sales"] / r["net_sales"] - 1) * 100,
-            "score": score
-        })
-    except Exception:
-        continue
-
-candidates.sort(key=lambda x: x["score"], reverse=True)
-
-print(f"\n=== BUY CANDIDATES ({len(candidates)} records) ===")
-for c in candidates[:50]:
     print(
-        f"{c['code']} | "
-        f"Price: {c['price']:6,} | "
-        f"ROE: {c['roe']:5.2f}% | "
-        f"PER: {c['per']:5.1f} | "
-        f"EPS(f): {c['eps']:6.1f} | "
-        f"Sales: {c['sales_growth']:+5.1f}% | "
-        f"Score: {c['score']:.1f}"
+        f"{r['Code']} | "
+        f"Price: {int(r['close_price']):6,} | "
+        f"ROE: {r['roe']:5.2f}% | "
+        f"PER: {r['per']:5.1f} | "
+        f"EPS(f): {r['forecast_eps']:6.1f} | "
+        f"Sales: {r['sales_growth']:+5.1f}% | "
+        f"Score: {r['score']:.1f}"
     )
 
 conn.close()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+SQLite メンテナンス
+- VACUUM で空き領域を回収（取り込みスクリプトの起動時からは外した）
+- 使い方: python vacuum.py [DB_PATH]
+"""
+
+import sys
+
+from schema import connect
+
+DB_PATH = sys.argv[1] if len(sys.argv) > 1 else "jquants.db"
+
+conn = connect(DB_PATH)
+print(f"VACUUM: {DB_PATH}")
+conn.execute("VACUUM;")
+conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+conn.close()
+print("VACUUM 完了")